@@ -6,3 +6,4 @@ __version__ = "0.4.5"
 
 TOP_DIR = Path(__file__).parent
 FAILED_ITEMS_DIR = TOP_DIR
+READWISE_HIGHLIGHT_MAX = 8191
@@ -1,4 +1,8 @@
 """Helper functions."""
+from functools import lru_cache
+
+
+@lru_cache(maxsize=4096)
 def sanitize_tag(tag: str) -> str:
     """Clean tag by replacing empty spaces with underscore.
 
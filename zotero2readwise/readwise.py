@@ -1,17 +1,25 @@
 """Readwise functions."""
-from dataclasses import dataclass
+import re
+import time
+from collections.abc import Iterable
+from dataclasses import dataclass, field, fields
 from enum import Enum
-from json import dump
 
+import orjson
 import requests
 
-from zotero2readwise import FAILED_ITEMS_DIR
+from zotero2readwise import FAILED_ITEMS_DIR, READWISE_HIGHLIGHT_MAX
 from zotero2readwise.exception import Zotero2ReadwiseError
 from zotero2readwise.helper import sanitize_tag
 from zotero2readwise.zotero import ZoteroItem
 
 HTTP_STATUS_OK = 200
-READWISE_HIGHLIGHT_MAX = 8191
+HTTP_STATUS_TOO_MANY_REQUESTS = 429
+READWISE_HIGHLIGHT_BATCH_SIZE = 100
+READWISE_MAX_RETRIES = 5
+ZOTERO_PDF_URL_TEMPLATE = (
+    "zotero://open-pdf/library/items/{attachment_id}?page={page}&annotation={annot_id}"
+)
 
 @dataclass
 class ReadwiseAPI:
@@ -30,7 +38,12 @@ class Category(Enum):
     podcasts = 4
 
 
-@dataclass
+# Zotero item types with a dedicated Readwise category, everything else is an article
+ZOTERO_TO_READWISE_CATEGORY = {"book": Category.books.name}
+DEFAULT_READWISE_CATEGORY = Category.articles.name
+
+
+@dataclass(slots=True)
 class ReadwiseHighlight:
     """Highlightclass for ReadWise API endpoints."""
     text: str
@@ -45,15 +58,21 @@ class ReadwiseHighlight:
     location_type: str | None = "page"
     highlighted_at: str | None = None
     highlight_url: str | None = None
+    _params: dict | None = field(init=False, default=None, repr=False, compare=False)
 
     def __post_init__(self):
         """Post init set location to None if none is set."""
         if not self.location:
             self.location = None
+        self._params = {
+            f.name: getattr(self, f.name)
+            for f in fields(self)
+            if f.init and getattr(self, f.name)
+        }
 
     def get_nonempty_params(self) -> dict:
         """Get nonempty params."""
-        return {k: v for k, v in self.__dict__.items() if v}
+        return self._params
 
 
 class Readwise:
@@ -64,21 +83,60 @@ class Readwise:
         self._header = {"Authorization": f"Token {self._token}"}
         self.endpoints = ReadwiseAPI
         self.failed_highlights: list = []
+        self._session = requests.Session()
+        self._session.headers.update(self._header)
 
     def create_highlights(self, highlights: list[dict]) -> None:
-        """Create Readwise higlights."""
-        resp = requests.post(
-            url=self.endpoints.highlights,
-            headers=self._header,
-            json={"highlights": highlights},
-            timeout=30,
-        )
+        """Create Readwise higlights in batches of READWISE_HIGHLIGHT_BATCH_SIZE."""
+        for i in range(0, len(highlights), READWISE_HIGHLIGHT_BATCH_SIZE):
+            self._post_highlights(highlights[i : i + READWISE_HIGHLIGHT_BATCH_SIZE])
+
+    @staticmethod
+    def _get_retry_after(resp: requests.Response, attempt: int) -> int:
+        """Get seconds to wait before retrying a throttled request.
+
+        Uses the `Retry-After` header, falls back to the seconds given in the
+        JSON `detail` message and finally to exponential backoff.
+        """
+        retry_after = resp.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+        try:
+            body = orjson.loads(resp.content)
+        except orjson.JSONDecodeError:
+            body = None
+        detail = body.get("detail") if isinstance(body, dict) else None
+        if isinstance(detail, str) and (match := re.search(r"(\d+) second", detail)):
+            return int(match[1])
+        return 2**attempt
+
+    def _post_highlights(self, highlights: list[dict]) -> None:
+        """Post a single batch of highlights to Readwise."""
+        for attempt in range(READWISE_MAX_RETRIES):
+            resp = self._session.post(
+                url=self.endpoints.highlights,
+                data=orjson.dumps({"highlights": highlights}),
+                headers={"Content-Type": "application/json"},
+                timeout=30,
+            )
+            if resp.status_code != HTTP_STATUS_TOO_MANY_REQUESTS:
+                break
+            if attempt < READWISE_MAX_RETRIES - 1:
+                wait = self._get_retry_after(resp, attempt)
+                print(f"Readwise rate limit reached, retrying in {wait} seconds...")
+                time.sleep(wait)
+
+        if resp.status_code == HTTP_STATUS_TOO_MANY_REQUESTS:
+            raise Zotero2ReadwiseError(
+                f"Uploading to Readwise failed after {READWISE_MAX_RETRIES} attempts:\n"
+                f"POST request Status Code={resp.status_code} ({resp.reason})"
+            )
         if resp.status_code != HTTP_STATUS_OK:
             error_log_file = (
                 f"error_log_{resp.status_code}_failed_post_request_to_readwise.json"
             )
-            with open(error_log_file, "w", encoding="utf-8") as f:
-                dump(resp.json(), f)
+            with open(error_log_file, "wb") as f:
+                f.write(resp.content)
             raise Zotero2ReadwiseError(
                 f"Uploading to Readwise failed with following details:\n"
                 f"POST request Status Code={resp.status_code} ({resp.reason})\n"
@@ -88,7 +146,7 @@ class Readwise:
     @staticmethod
     def convert_tags_to_readwise_format(tags: list[str]) -> str:
         """Convert tags to Readwise format."""
-        return " ".join([f".{sanitize_tag(t.lower())}" for t in tags])
+        return " ".join(f".{sanitize_tag(t.lower())}" for t in tags)
 
     def format_readwise_note(self, tags, comment) -> str | None:
         """Format readwise note."""
@@ -107,24 +165,24 @@ class Readwise:
         highlight_note = self.format_readwise_note(
             tags=annot.tags, comment=annot.comment
         )
-        if annot.page_label and annot.page_label.isnumeric():
+        if annot.page_label and annot.page_label.isdigit():
             location = int(annot.page_label)
         else:
             location = 0
         highlight_url = None
-        if annot.attachment_url is not None:
-            attachment_id = annot.attachment_url.split("/")[-1]
-            annot_id = annot.annotation_url.split("/")[-1]
-            highlight_url = f"zotero://open-pdf/library/items/{attachment_id}?page={location}%&annotation={annot_id}"
+        if annot.attachment_url and annot.annotation_url:
+            attachment_id = annot.attachment_url.rpartition("/")[2]
+            annot_id = annot.annotation_url.rpartition("/")[2]
+            highlight_url = ZOTERO_PDF_URL_TEMPLATE.format(
+                attachment_id=attachment_id, page=location, annot_id=annot_id
+            )
         return ReadwiseHighlight(
             text=annot.text,
             title=annot.title,
             note=highlight_note,
             author=annot.creators,
-            category=(
-                Category.articles.name
-                if annot.document_type != "book"
-                else Category.books.name
+            category=ZOTERO_TO_READWISE_CATEGORY.get(
+                annot.document_type, DEFAULT_READWISE_CATEGORY
             ),
             highlighted_at=annot.annotated_at,
             source_url=annot.source_url,
@@ -137,16 +195,27 @@ class Readwise:
         )
 
     def post_zotero_annotations_to_readwise(
-        self, zotero_annotations: list[ZoteroItem]
-    ) -> None:
-        """Post Zotero annotations to Readwise."""
+        self, zotero_annotations: Iterable[ZoteroItem]
+    ) -> int:
+        """Post Zotero annotations to Readwise.
+
+        Annotations are consumed lazily and uploaded in batches of
+        READWISE_HIGHLIGHT_BATCH_SIZE, so an iterator of items can be passed.
+
+        Returns:
+            int: Number of highlights successfully uploaded.
+        """
         print(
-            f"\nReadwise: Push {len(zotero_annotations)} Zotero annotations/notes to Readwise...\n"
-            f"It may take some time depending on the number of highlights...\n"
-            f"A complete message will show up once it's done!\n"
+            "\nReadwise: Push Zotero annotations/notes to Readwise...\n"
+            "It may take some time depending on the number of highlights...\n"
+            "A complete message will show up once it's done!\n"
         )
-        rw_highlights = []
+        # Reused for every batch; create_highlights is done with it once it returns.
+        rw_highlights: list[dict] = []
+        uploaded = 0
+        total = 0
         for annot in zotero_annotations:
+            total += 1
             try:
                 if len(annot.text) >= READWISE_HIGHLIGHT_MAX:
                     print(
@@ -163,17 +232,24 @@ class Readwise:
                 self.failed_highlights.append(annot.get_nonempty_params())
                 continue  # Go to next annot
             rw_highlights.append(rw_highlight.get_nonempty_params())
-        self.create_highlights(rw_highlights)
+            if len(rw_highlights) >= READWISE_HIGHLIGHT_BATCH_SIZE:
+                self.create_highlights(rw_highlights)
+                uploaded += len(rw_highlights)
+                rw_highlights.clear()
+        if rw_highlights:
+            self.create_highlights(rw_highlights)
+            uploaded += len(rw_highlights)
 
         finished_msg = ""
         if self.failed_highlights:
             finished_msg = (
-                f"\nNOTE: {len(self.failed_highlights)} highlights (out of {len(self.failed_highlights)}) failed "
+                f"\nNOTE: {len(self.failed_highlights)} highlights (out of {total}) failed "
                 f"to upload to Readwise.\n"
             )
 
-        finished_msg += f"\n{len(rw_highlights)} highlights were successfully uploaded to Readwise.\n\n"
+        finished_msg += f"\n{uploaded} highlights were successfully uploaded to Readwise.\n\n"
         print(finished_msg)
+        return uploaded
 
     def save_failed_items_to_json(self, json_filepath_failed_items: str = ""):
         """Save failed items to json file for debbuging purposes."""
@@ -183,8 +259,8 @@ class Readwise:
         else:
             out_filepath = FAILED_ITEMS_DIR.joinpath("failed_readwise_items.json")
 
-        with open(out_filepath, "w", encoding="utf-8") as f:
-            dump(self.failed_highlights, f)
+        with open(out_filepath, "wb") as f:
+            f.write(orjson.dumps(self.failed_highlights))
         print(
             f"{len(self.failed_highlights)} highlights failed to format (hence failed to upload to Readwise).\n"
             f"Detail of failed items are saved into {out_filepath}"
@@ -1,16 +1,20 @@
 """Functions and classes regarding Zotero."""
-import re
-from dataclasses import dataclass, field
-from json import dump
+from collections.abc import Iterator
+from dataclasses import dataclass, field, fields
 from os import environ
+from pathlib import Path
 
+import orjson
 from pyzotero.zotero import Zotero
 from pyzotero.zotero_errors import ParamNotPassedError, UnsupportedParamsError
 
-from zotero2readwise import FAILED_ITEMS_DIR
+from zotero2readwise import FAILED_ITEMS_DIR, READWISE_HIGHLIGHT_MAX
 
+ZOTERO_ITEM_KEYS_BATCH_SIZE = 50
+METADATA_CACHE_FILE = FAILED_ITEMS_DIR.joinpath("metadata_cache.json")
 
-@dataclass
+
+@dataclass(slots=True)
 class ZoteroItem:
     """Zotero item class."""
     key: str
@@ -31,6 +35,7 @@ class ZoteroItem:
     page_label: str | None = None
     color: str | None = None
     relations: dict | None = field(init=True, default=None)
+    _params: dict | None = field(init=False, default=None, repr=False, compare=False)
 
     def __post_init__(self):
         """Post init function to clean up items."""
@@ -49,15 +54,25 @@ class ZoteroItem:
             et_al = " et al."
             max_length = 1024 - len(et_al)
             if len(self.creators) > max_length:
-                # Reset creators_str and find the first n creators that fit in max_length
-                while len(self.creators) < max_length:
-                    match = re.search(r"(.*),[^,]+$", self.creators)[1]
-                    self.creators = match
+                # Drop trailing creators until the remaining ones fit in max_length
+                while len(self.creators) > max_length:
+                    idx = self.creators.rfind(",")
+                    if idx == -1:
+                        self.creators = self.creators[:max_length]
+                        break
+                    self.creators = self.creators[:idx]
                 self.creators += et_al
 
+        # Fields are not mutated after this point, so compute the params once.
+        self._params = {
+            f.name: getattr(self, f.name)
+            for f in fields(self)
+            if f.init and getattr(self, f.name)
+        }
+
     def get_nonempty_params(self) -> dict:
         """Get nonempty parameters."""
-        return {k: v for k, v in self.__dict__.items() if v}
+        return self._params
 
 
 def get_zotero_client(
@@ -114,13 +129,134 @@ def get_zotero_client(
 
 class ZoteroAnnotationsNotes:
     """Class for Zotero Annotations notes."""
-    def __init__(self, zotero_client: Zotero, filter_colors: list[str]):
+    def __init__(
+        self,
+        zotero_client: Zotero,
+        filter_colors: list[str] | None = None,
+        metadata_cache_file: Path | None = None,
+    ):
         """Init function."""
         self.zot = zotero_client
         self.failed_items: list[dict] = []
         self._cache: dict = {}
         self._parent_mapping: dict = {}
-        self.filter_colors: list[str] = filter_colors
+        self._items: dict = {}
+        # Zotero item versions of the entries in `_cache` and `_parent_mapping`
+        self._versions: dict = {}
+        # Library version at the start of the run that saved the cache, and of this run
+        self._cached_library_version: int = 0
+        self.library_version: int | None = None
+        self._cache_validated: bool = False
+        self.filter_colors: frozenset[str] = frozenset(filter_colors or ())
+        self._filter_enabled: bool = bool(self.filter_colors)
+        self.metadata_cache_file = metadata_cache_file
+        if metadata_cache_file is not None:
+            self.load_metadata_cache()
+
+    def load_metadata_cache(self) -> None:
+        """Load item metadata cached by a previous run, if any."""
+        try:
+            with open(self.metadata_cache_file, "rb") as f:
+                cached = orjson.loads(f.read())
+        except FileNotFoundError:
+            return
+        except (orjson.JSONDecodeError, OSError):
+            print(f"Could not read {self.metadata_cache_file}, ignoring the metadata cache")
+            return
+        self._cache = cached.get("metadata", {})
+        self._parent_mapping = cached.get("parent_mapping", {})
+        self._versions = cached.get("versions", {})
+        self._cached_library_version = cached.get("library_version", 0)
+
+    def record_library_version(self) -> None:
+        """Record the library version before fetching anything in this run.
+
+        Items edited while the run is in progress get a newer version, so the
+        next run still sees them as modified when validating the cache.
+        """
+        if self.metadata_cache_file is not None:
+            self.library_version = self.zot.last_modified_version()
+
+    def validate_metadata_cache(self) -> None:
+        """Drop cached entries for items modified since the cache was built."""
+        if not self._versions:
+            self._cache_validated = True
+            return
+        changed = self.zot.item_versions(since=self._cached_library_version)
+        for key, version in changed.items():
+            if key in self._versions and self._versions[key] != version:
+                del self._versions[key]
+                self._cache.pop(key, None)
+                self._parent_mapping.pop(key, None)
+        self._cache_validated = True
+
+    def save_metadata_cache(self) -> None:
+        """Save item metadata so later runs can skip fetching unchanged items."""
+        if self.metadata_cache_file is None:
+            return
+        cached = {
+            "metadata": {k: v for k, v in self._cache.items() if k in self._versions},
+            "parent_mapping": {
+                k: v for k, v in self._parent_mapping.items() if k in self._versions
+            },
+            "versions": self._versions,
+            # Only move the baseline forward once the cache has been checked against it
+            "library_version": (
+                self.library_version or 0
+                if self._cache_validated
+                else self._cached_library_version
+            ),
+        }
+        self.metadata_cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.metadata_cache_file, "wb") as f:
+            f.write(orjson.dumps(cached))
+
+    def has_selected_color(self, annot: dict) -> bool:
+        """Check whether an item passes the color filter (if any).
+
+        Only annotations have a color, so notes always pass.
+        """
+        data = annot["data"]
+        return (
+            not self._filter_enabled
+            or data.get("itemType") != "annotation"
+            or data.get("annotationColor") in self.filter_colors
+        )
+
+    def _get_item(self, item_key: str) -> dict:
+        """Get a Zotero item, fetching it only once per key."""
+        if item_key not in self._items:
+            self._items[item_key] = self.zot.item(item_key)
+        return self._items[item_key]
+
+    def prefetch_items(self, item_keys: set[str]) -> None:
+        """Fetch uncached Zotero items in batches of ZOTERO_ITEM_KEYS_BATCH_SIZE."""
+        keys = sorted(k for k in item_keys if k and k not in self._items)
+        for i in range(0, len(keys), ZOTERO_ITEM_KEYS_BATCH_SIZE):
+            batch = keys[i : i + ZOTERO_ITEM_KEYS_BATCH_SIZE]
+            for item in self.zot.items(itemKey=",".join(batch), limit=len(batch)):
+                self._items[item["key"]] = item
+
+    def prefetch_item_metadata(self, annots: list[dict]) -> None:
+        """Prefetch parent and top items of the annotations/notes that will be formatted."""
+        needed_keys = {
+            annot["data"].get("parentItem")
+            for annot in annots
+            if self._needs_metadata(annot)
+        }
+        parent_keys = needed_keys - self._parent_mapping.keys()
+        self.prefetch_items(parent_keys)
+        top_keys = {
+            self._items[k]["data"].get("parentItem")
+            for k in parent_keys
+            if k in self._items
+        }
+        # Parents mapped by an earlier run whose top item was dropped from the cache
+        top_keys.update(
+            self._parent_mapping[k]
+            for k in needed_keys & self._parent_mapping.keys()
+        )
+        self.prefetch_items(top_keys - self._cache.keys())
 
     def get_item_metadata(self, annot: dict) -> dict:
         """Get metadata for item."""
@@ -128,43 +264,32 @@ class ZoteroAnnotationsNotes:
         # A Zotero annotation or note must have a parent with parentItem key.
         parent_item_key = data["parentItem"]
 
-        if parent_item_key in self._parent_mapping:
-            top_item_key = self._parent_mapping[parent_item_key]
-            if top_item_key in self._cache:
-                return self._cache[top_item_key]
-        else:
-            parent_item = self.zot.item(parent_item_key)
-            top_item_key = parent_item["data"].get("parentItem", None)
-            self._parent_mapping[parent_item_key] = (
-                top_item_key if top_item_key else parent_item_key
-            )
+        top_item_key = self._parent_mapping.get(parent_item_key)
+        if top_item_key is None:
+            parent_item = self._get_item(parent_item_key)
+            top_item_key = parent_item["data"].get("parentItem") or parent_item_key
+            self._parent_mapping[parent_item_key] = top_item_key
+            self._versions[parent_item_key] = parent_item.get("version")
+        if top_item_key in self._cache:
+            return self._cache[top_item_key]
 
-        if top_item_key:
-            top_item = self.zot.item(top_item_key)
-            data = top_item["data"]
-        else:
-            top_item = parent_item
-            data = top_item["data"]
-            top_item_key = data["key"]
+        # When the parent is itself a top item, it is served from `_items`.
+        top_item = self._get_item(top_item_key)
+        data = top_item["data"]
 
         metadata = {
             "title": data["title"],
             "tags": data["tags"],
             "document_type": data["itemType"],
             "source_url": top_item["links"]["alternate"]["href"],
-            "creators": "",
+            "creators": ", ".join(
+                f"{creator['firstName']} {creator['lastName']}"
+                if "firstName" in creator
+                else creator["name"]
+                for creator in data.get("creators", [])
+            ),
             "attachment_url": "",
         }
-        if "creators" in data:
-            for creator in data["creators"]:
-                if metadata["creators"] != "":
-                    metadata["creators"] += ", "
-                try:
-                    metadata["creators"] += (
-                        creator["firstName"] + " " + creator["lastName"]
-                    )
-                except Exception:
-                    metadata["creators"] += creator["name"]
         if (
             "attachment" in top_item["links"]
             and top_item["links"]["attachment"]["attachmentType"] == "application/pdf"
@@ -172,46 +297,73 @@ class ZoteroAnnotationsNotes:
             metadata["attachment_url"] = top_item["links"]["attachment"]["href"]
 
         self._cache[top_item_key] = metadata
+        self._versions[top_item_key] = top_item.get("version")
         return metadata
 
-    def format_item(self, annot: dict) -> ZoteroItem:
-        """Format Zotero item."""
-        data = annot["data"]
+    @staticmethod
+    def _get_text_and_comment(data: dict) -> tuple[str, str] | None:
+        """Get the text and comment of a Zotero annotation or note.
+
+        Returns None for unsupported item and annotation types.
+        """
         item_type = data["itemType"]
         annotation_type = data.get("annotationType")
-        metadata = self.get_item_metadata(annot)
-
-        text = ""
-        comment = ""
         if item_type == "annotation":
             if annotation_type == "highlight":
-                text = data["annotationText"]
-                comment = data["annotationComment"]
-            elif annotation_type == "note":
-                text = data["annotationComment"]
-                comment = ""
+                return data.get("annotationText") or "", data.get("annotationComment") or ""
+            if annotation_type == "note":
+                return data.get("annotationComment") or "", ""
+            return None
+        if item_type == "note":
+            return data.get("note") or "", ""
+        return None
+
+    def _needs_metadata(self, annot: dict) -> bool:
+        """Check whether an item will be formatted and hence needs its metadata."""
+        if not self.has_selected_color(annot):
+            return False
+        try:
+            text_and_comment = self._get_text_and_comment(annot["data"])
+        except KeyError:
+            return False
+        return (
+            text_and_comment is not None
+            and 0 < len(text_and_comment[0]) < READWISE_HIGHLIGHT_MAX
+        )
+
+    def format_item(self, annot: dict) -> ZoteroItem | None:
+        """Format Zotero item.
+
+        Returns None if the item type is not supported, has no text or is too
+        long for Readwise.
+        """
+        data = annot["data"]
+        item_type = data["itemType"]
+        annotation_type = data.get("annotationType")
+
+        text_and_comment = self._get_text_and_comment(data)
+        if text_and_comment is None:
+            if item_type != "annotation":
+                print("Only Zotero item types of 'note' and 'annotation' are supported.")
             elif annotation_type == "image":
                 print("Image annotations are not currently supported.")
-                raise NotImplementedError(
-                    "Image  annotations are not currently supported."
-                )
             else:
-                print(
-                    f"Annotations of type {annotation_type} are not currently supported."
-                )
-                raise NotImplementedError(
-                    f"Annotations of type {annotation_type} are not currently supported."
-                )
-        elif item_type == "note":
-            text = data["note"]
-            comment = ""
-        else:
-            raise NotImplementedError(
-                "Only Zotero item types of 'note' and 'annotation' are supported."
+                print(f"Annotations of type {annotation_type} are not currently supported.")
+            return None
+
+        text, comment = text_and_comment
+        if not text:
+            return None
+        # Reject before the metadata lookup, Readwise would refuse it anyway.
+        if len(text) >= READWISE_HIGHLIGHT_MAX:
+            print(
+                f"A Zotero annotation (item_key={data['key']} and version={data['version']}) "
+                f"cannot be uploaded since the highlight/note is very long. "
+                f"A Readwise highlight can be up to {READWISE_HIGHLIGHT_MAX} characters."
             )
+            return None
 
-        if text == "":
-            raise ValueError("No annotation or note data is found.")
+        metadata = self.get_item_metadata(annot)
         return ZoteroItem(
             key=data["key"],
             version=data["version"],
@@ -233,24 +385,27 @@ class ZoteroAnnotationsNotes:
             relations=data["relations"],
         )
 
-    def format_items(self, annots: list[dict]) -> list[ZoteroItem]:
-        """Format all Zotero items."""
-        formatted_annots = []
+    def iter_format(self, annots: list[dict]) -> Iterator[ZoteroItem]:
+        """Format Zotero items one at a time, skipping those failing the color filter."""
         print(
             f"ZOTERO: Start formatting {len(annots)} annotations/notes...\n"
             f"It may take some time depending on the number of annotations...\n"
             f"A complete message will show up once it's done!\n"
         )
+        self.prefetch_item_metadata(annots)
         for annot in annots:
             try:
-                if (
-                    len(self.filter_colors) == 0
-                    or annot["data"]["annotationColor"] in self.filter_colors
-                ):
-                    formatted_annots.append(self.format_item(annot))
+                # Zotero2Readwise already filters while paging, but items can also be
+                # passed in directly through run() or format_items().
+                if not self.has_selected_color(annot):
+                    continue
+                formatted_annot = self.format_item(annot)
             except Exception:
+                formatted_annot = None
+            if formatted_annot is None:
                 self.failed_items.append(annot)
                 continue
+            yield formatted_annot
 
         finished_msg = "\nZOTERO: Formatting Zotero Items is completed!!\n\n"
         if self.failed_items:
@@ -259,7 +414,10 @@ class ZoteroAnnotationsNotes:
                 f"You can run `save_failed_items_to_json()` class method to save those items."
             )
         print(finished_msg)
-        return formatted_annots
+
+    def format_items(self, annots: list[dict]) -> list[ZoteroItem]:
+        """Format all Zotero items."""
+        return list(self.iter_format(annots))
 
     def save_failed_items_to_json(self, json_filepath_failed_items: str | None = None):
         """Save failed items to json."""
@@ -269,6 +427,6 @@ class ZoteroAnnotationsNotes:
         else:
             out_filepath = FAILED_ITEMS_DIR.joinpath("failed_zotero_items.json")
 
-        with open(out_filepath, "w", encoding="utf-8") as f:
-            dump(self.failed_items, f, indent=4)
+        with open(out_filepath, "wb") as f:
+            f.write(orjson.dumps(self.failed_items, option=orjson.OPT_INDENT_2))
         print(f"\nZOTERO: Detail of failed items are saved into {out_filepath}\n")
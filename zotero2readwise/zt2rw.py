@@ -1,6 +1,18 @@
 """Files for copying data from Zotero to Readwise."""
+import threading
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+
 from zotero2readwise.readwise import Readwise
-from zotero2readwise.zotero import ZoteroAnnotationsNotes, get_zotero_client
+from zotero2readwise.zotero import (
+    METADATA_CACHE_FILE,
+    ZoteroAnnotationsNotes,
+    get_zotero_client,
+)
+
+ZOTERO_PAGE_SIZE = 100
+# Kept low to stay within the Zotero API rate limits
+ZOTERO_MAX_WORKERS = 5
 
 
 class Zotero2Readwise:
@@ -18,12 +30,16 @@ class Zotero2Readwise:
     ):
         """Init function."""
         self.readwise = Readwise(readwise_token)
-        self.zotero_client = get_zotero_client(
-            library_id=zotero_library_id,
-            library_type=zotero_library_type,
-            api_key=zotero_key,
+        self._zotero_client_kwargs = {
+            "library_id": zotero_library_id,
+            "library_type": zotero_library_type,
+            "api_key": zotero_key,
+        }
+        self.zotero_client = get_zotero_client(**self._zotero_client_kwargs)
+        self._thread_local = threading.local()
+        self.zotero = ZoteroAnnotationsNotes(
+            self.zotero_client, filter_colors, metadata_cache_file=METADATA_CACHE_FILE
         )
-        self.zotero = ZoteroAnnotationsNotes(self.zotero_client, filter_colors)
         self.include_annots = include_annotations
         self.include_notes = include_notes
         self.since = since
@@ -47,32 +63,41 @@ class Zotero2Readwise:
 
     def run(self, zot_annots_notes: list[dict] | None = None) -> None:
         """Function to handle the process of getting data from Zotero to Readwise."""
+        self.zotero.record_library_version()
         if zot_annots_notes is None:
             zot_annots_notes = self.get_all_zotero_items()
 
-        if zot_annots_notes:
-            formatted_items = self.zotero.format_items(zot_annots_notes)
-        else:
-            print("No items to format.")
-            formatted_items = []
-
-        if self.zotero.failed_items:
-            self.zotero.save_failed_items_to_json("failed_zotero_items.json")
-
-        if formatted_items:
-            self.readwise.post_zotero_annotations_to_readwise(formatted_items)
-        else:
+        uploaded = 0
+        try:
+            self.zotero.validate_metadata_cache()
+            if zot_annots_notes:
+                # Formatted items are streamed straight into the batched Readwise upload.
+                uploaded = self.readwise.post_zotero_annotations_to_readwise(
+                    self.zotero.iter_format(zot_annots_notes)
+                )
+            else:
+                print("No items to format.")
+        finally:
+            # A failed upload must not lose the formatting failures or fetched metadata.
+            if self.zotero.failed_items:
+                self.zotero.save_failed_items_to_json("failed_zotero_items.json")
+            self.zotero.save_metadata_cache()
+
+        if not uploaded:
             print("No new items.")
 
-    def retrieve_all(self, item_type: str, since: int = 0):
+    def retrieve_all(self, item_type: str, since: int = 0) -> Iterator[dict]:
         """Retrieves all items of a given type from Zotero Database since a given timestamp.
 
+        Items not matching the color filter are dropped page by page, so they are
+        never accumulated in memory.
+
         Args:
             item_type (str): Either "annotation" or "note".
             since (int): Timestamp in seconds since the Unix epoch. Defaults to 0.
 
         Returns:
-            List[Dict]: List of dictionaries containing the retrieved items.
+            Iterator[Dict]: Iterator over dictionaries containing the retrieved items.
         """
         if item_type not in ["annotation", "note"]:
             raise ValueError("item_type must be either 'annotation' or 'note'")
@@ -83,5 +108,41 @@ class Zotero2Readwise:
             print(f"Retrieving {item_type}s since last run from Zotero Database")
 
         print("It may take some time...")
-        query = self.zotero_client.items(itemType=item_type, since=since)
-        return self.zotero_client.everything(query)
+        return self._iter_pages(item_type, since)
+
+    def _get_thread_zotero_client(self):
+        """Get a Zotero client for the current worker thread.
+
+        Pyzotero clients keep per-request state, so they cannot be shared between threads.
+        """
+        if not hasattr(self._thread_local, "client"):
+            self._thread_local.client = get_zotero_client(**self._zotero_client_kwargs)
+        return self._thread_local.client
+
+    def _fetch_page(self, item_type: str, since: int, start: int) -> list[dict]:
+        """Fetch one page of Zotero items from a worker thread."""
+        return self._get_thread_zotero_client().items(
+            itemType=item_type, since=since, start=start, limit=ZOTERO_PAGE_SIZE
+        )
+
+    def _iter_pages(self, item_type: str, since: int) -> Iterator[dict]:
+        """Page through Zotero items, yielding those passing the color filter.
+
+        The first page gives the total number of results, the remaining pages are
+        then fetched concurrently and yielded in order.
+        """
+        page = self.zotero_client.items(
+            itemType=item_type, since=since, limit=ZOTERO_PAGE_SIZE
+        )
+        total = int(self.zotero_client.request.headers.get("Total-Results", 0))
+        yield from (a for a in page if self.zotero.has_selected_color(a))
+
+        offsets = range(ZOTERO_PAGE_SIZE, total, ZOTERO_PAGE_SIZE)
+        if not offsets:
+            return
+        with ThreadPoolExecutor(max_workers=ZOTERO_MAX_WORKERS) as executor:
+            pages = executor.map(
+                lambda start: self._fetch_page(item_type, since, start), offsets
+            )
+            for page in pages:
+                yield from (a for a in page if self.zotero.has_selected_color(a))